@@ -1,14 +1,43 @@
 import os
 import time
-import requests
+import atexit
+import json
+import hashlib
 import tempfile
+import threading
+import warnings
+import random
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import numpy as np
 from PIL import Image
 import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
 import torch  # ← Critical for correct tensor return
+import folder_paths
+
+# Optional: PyTurboJPEG encodes/decodes JPEG via libjpeg-turbo without PIL's per-row overhead
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB, TJSAMP_420
+    _turbojpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbojpeg = None
+
+# Optional: torchvision's nvJPEG encoder for inputs that already live on CUDA
+try:
+    from torchvision.io import encode_jpeg as _encode_jpeg
+except ImportError:
+    _encode_jpeg = None
+
+log = logging.getLogger("comfyui.topaz")
 
 BASE_URL = "https://api.topazlabs.com/image/v1"
 
+# Set TOPAZ_UPSCALER_DEBUG=1 to validate input tensor dtype/range before upload
+DEBUG_CHECKS = os.environ.get("TOPAZ_UPSCALER_DEBUG") == "1"
+
 # Modes
 TOPAZ_MODES = ["enhance", "sharpen", "denoise", "restore", "lighting"]
 
@@ -21,70 +50,349 @@ DENOISE_GAN_MODELS = ["Normal", "Strong", "Extreme"]
 RESTORE_GEN_MODELS = ["Dust-Scratch"]
 LIGHTING_GAN_MODELS = ["Adjust", "White Balance"]
 
-TOPAZ_MODELS = list(set(
+# Deduplicated in declaration order so the dropdown is stable between runs
+TOPAZ_MODELS = list(dict.fromkeys(
     ENHANCE_GAN_MODELS + ENHANCE_GEN_MODELS +
     SHARPEN_GAN_MODELS + SHARPEN_GEN_MODELS +
     DENOISE_GAN_MODELS + RESTORE_GEN_MODELS + LIGHTING_GAN_MODELS
 ))
 
+def _build_submit_paths():
+    # Submit endpoint for every valid (mode, model) pair, sanity-checked at import
+    paths = {}
+    for mode, models, path in (
+        ("enhance", ENHANCE_GEN_MODELS, "/enhance-gen/async"),
+        ("enhance", ENHANCE_GAN_MODELS, "/enhance/async"),
+        ("sharpen", SHARPEN_GEN_MODELS, "/sharpen-gen/async"),
+        ("sharpen", SHARPEN_GAN_MODELS, "/sharpen/async"),
+        ("denoise", DENOISE_GAN_MODELS, "/denoise/async"),
+        ("restore", RESTORE_GEN_MODELS, "/restore-gen/async"),
+        ("lighting", LIGHTING_GAN_MODELS, "/lighting/async"),
+    ):
+        for model in models:
+            if (mode, model) in paths:
+                raise ValueError(f"Model '{model}' listed under two endpoints for mode '{mode}'")
+            paths[(mode, model)] = path
+    missing = set(TOPAZ_MODES) - {mode for mode, _ in paths}
+    if missing:
+        raise ValueError(f"No models defined for mode(s): {sorted(missing)}")
+    return paths
+
+
+_SUBMIT_PATHS = _build_submit_paths()
+
+# Status polling backoff (seconds)
+POLL_INITIAL_DELAY = 1.0
+POLL_INITIAL_MAX = 4.0
+POLL_MAX_DELAY = 15.0
+POLL_BACKOFF = 1.5
+# Floor for progress-rate based sleeps near completion
+POLL_MIN_DELAY = 0.3
+# First poll at whichever comes earlier: this fraction of the ETA, or this margin before it
+POLL_ETA_FRACTION = 0.8
+POLL_ETA_MARGIN = 5.0
+
+# Transient upload encoding: the server re-decodes it, so favour size and speed
+UPLOAD_JPEG_QUALITY = 87
+
+# Frames of a batch processed concurrently: keeps large batches under the API's rate limits
+MAX_CONCURRENT_JOBS = 4
+
+# On-disk result cache keyed by the encoded upload + settings, evicted least-recently-used
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "comfyui-topaz")
+CACHE_MAX_BYTES = 5 * 1024 ** 3
+
+# Circuit breaker: after this many consecutive failures, fail fast for the cooldown
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+
+# Session defaults to drop when leaving the Topaz API host
+NO_API_HEADERS = {"X-API-Key": None, "Accept": None}
+
+# Retries for transient 429/5xx responses: exponential backoff plus random jitter
+RETRY_BACKOFF = 0.5
+RETRY_JITTER = 0.3
+SUBMIT_RETRIES = 3
+
+# Connect timeout for every HTTP call; read timeouts are set per call
+CONNECT_TIMEOUT = 10.0
+
+# Streamed download read size
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# Results at least this large are fetched as parallel byte ranges when the host allows it
+RANGE_MIN_BYTES = 8 * 1024 * 1024
+RANGE_SLICES = 4
+
 FORMAT_ACCEPT = {"jpeg": "image/jpeg", "png": "image/png", "tiff": "image/tiff"}
 FORMAT_MAGIC = {
-    "jpeg": b'\xff\xd8\xff',
-    "png": b'\x89PNG\r\n\x1a\n',
-    "tiff": [b'II*\x00', b'MM*\x00']
+    "jpeg": (b'\xff\xd8\xff',),
+    "png": (b'\x89PNG\r\n\x1a\n',),
+    "tiff": (b'II*\x00', b'MM*\x00'),
+}
+
+# Static widget spec: ComfyUI queries INPUT_TYPES on every graph refresh
+TOPAZ_INPUT_TYPES = {
+    "required": {
+        "image": ("IMAGE",),
+        "api_key": ("STRING", {
+            "multiline": False,
+            "default": "",
+            "placeholder": "Enter your Topaz API key"
+        }),
+        "mode": (TOPAZ_MODES, {"default": "enhance"}),
+        "model": (TOPAZ_MODELS, {"default": "Standard V2"}),
+        "scale_multiplier": ("FLOAT", {
+            "default": 1.0,
+            "min": 1.0,
+            "max": 4.0,
+            "step": 0.1,
+            "display": "slider",
+            "tooltip": "Set >1.0 to auto-upscale. Set exactly 1.0 to use manual width/height."
+        }),
+    },
+    "optional": {
+        "output_width": ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 32000,
+            "step": 64,
+            "display": "number",
+            "visible": {"condition": {"scale_multiplier": ["1.0"]}, "value": True},
+            "tooltip": "Only used when scale_multiplier = 1.0"
+        }),
+        "output_height": ("INT", {
+            "default": 0,
+            "min": 0,
+            "max": 32000,
+            "step": 64,
+            "display": "number",
+            "visible": {"condition": {"scale_multiplier": ["1.0"]}, "value": True},
+            "tooltip": "Only used when scale_multiplier = 1.0"
+        }),
+        "crop_to_fill": ("BOOLEAN", {"default": False}),
+        "output_format": (["jpeg", "png", "tiff"], {"default": "jpeg"}),
+        "face_enhancement": ("BOOLEAN", {"default": True}),
+        "denoise_strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
+        "sharpen_strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
+        "strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
+        "fix_compression": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.05}),
+        "timeout_seconds": ("INT", {"default": 300, "min": 60, "max": 1800, "step": 30}),
+        "upload_quality": ("INT", {
+            "default": UPLOAD_JPEG_QUALITY,
+            "min": 50,
+            "max": 100,
+            "step": 1,
+            "tooltip": "JPEG quality of the image uploaded to Topaz (jpeg output_format only)"
+        }),
+        "use_cache": ("BOOLEAN", {
+            "default": True,
+            "tooltip": f"Reuse results for identical image + settings from {CACHE_DIR}"
+        }),
+    }
 }
 
+
+def _cache_key(input_bytes, mode, params):
+    h = hashlib.blake2b(digest_size=16)
+    h.update(input_bytes)
+    h.update(f"|{mode}|".encode())
+    h.update(json.dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+def _cache_load(key, output_format):
+    path = os.path.join(CACHE_DIR, f"{key}.{output_format}")
+    try:
+        with open(path, "rb") as f:
+            buf = io.BytesIO(f.read())
+        os.utime(path)  # mark as recently used
+        return buf
+    except OSError:
+        return None
+
+
+def _cache_store(key, output_format, buf):
+    tmp_name = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            tmp_name = tmp.name
+            tmp.write(buf.getbuffer())
+        os.replace(tmp_name, os.path.join(CACHE_DIR, f"{key}.{output_format}"))
+    except OSError as e:
+        log.warning("[Topaz] Cache write failed: %s", e)
+        if tmp_name is not None:
+            try:
+                os.unlink(tmp_name)
+            except OSError:
+                pass
+        return
+
+    # Batch workers evict concurrently: entries may vanish under us
+    try:
+        entries = []
+        for entry in os.scandir(CACHE_DIR):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= CACHE_MAX_BYTES:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+    except OSError as e:
+        log.warning("[Topaz] Cache eviction failed: %s", e)
+
+
+def _get_retry():
+    # Idempotent requests only; submits are retried by hand in _submit_job
+    kwargs = dict(total=4, backoff_factor=RETRY_BACKOFF, status_forcelist=[429, 500, 502, 503, 504],
+                  allowed_methods=["GET", "HEAD"], raise_on_status=False)
+    try:
+        return Retry(backoff_jitter=RETRY_JITTER, **kwargs)
+    except TypeError:  # urllib3 < 2.0 has no jitter support
+        return Retry(**kwargs)
+
+
+def _clamp_dim(v, lo=64, hi=32000, step=1):
+    # Round rather than truncate so e.g. 333 × 1.5 gives 500, not 499
+    v = int(round(v / step)) * step
+    return max(lo, min(hi, v))
+
+
+def _quantize_u8(frame):
+    # Scale/round/clamp on the tensor's device so only uint8 crosses to the host
+    return frame.mul(255.0).round_().clamp_(0, 255).to(torch.uint8)
+
+
+def _form_float(v):
+    # Widget floats carry binary noise (0.30000000000000004); send a clean decimal
+    return str(round(float(v), 4))
+
+
+def _read_into(raw, view, start, end):
+    off = start
+    while off < end:
+        n = raw.readinto(view[off:min(end, off + DOWNLOAD_CHUNK_SIZE)])
+        if not n:
+            raise IOError(f"Download truncated at byte {off}, expected up to {end}")
+        off += n
+
+
+def _progress_step(prog, logged_prog):
+    try:
+        return abs(float(prog) - float(logged_prog))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _valid_magic(head, output_format):
+    if head.startswith(FORMAT_MAGIC.get(output_format, ())):
+        return True
+    log.debug("[Topaz] Expected %s, got header %r", output_format, head)
+    return False
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+def _retry_after(resp, default):
+    try:
+        return max(0.0, float(resp.headers.get("Retry-After", default)))
+    except ValueError:  # HTTP-date form: not worth parsing here
+        return default
+
+
 class TopazUpscaler:
+    # Shared across invocations so submit/poll/download reuse one TLS connection
+    _session = None
+
+    # Worker threads for batch frames, reused across runs
+    _executor = None
+    _executor_lock = threading.Lock()
+
+    # Cleared the first time nvJPEG encode fails so later frames go straight to the CPU path
+    _gpu_jpeg = _encode_jpeg is not None
+
+    # Consecutive API failures shared by all instances; guarded by _breaker_lock.
+    # "probing" is set while the single half-open request is in flight
+    _breaker = {"fails": 0, "opened_at": 0.0, "probing": False}
+    _breaker_lock = threading.Lock()
+
+    @classmethod
+    def _get_session(cls):
+        if cls._session is None:
+            session = requests.Session()
+            # Per-host pool sized for every batch job running a ranged download at once
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=MAX_CONCURRENT_JOBS * RANGE_SLICES,
+                                  max_retries=_get_retry())
+            session.mount("https://", adapter)
+            session.headers["Accept"] = "application/json"
+            # Kept open across runs for keep-alive; released when ComfyUI exits
+            atexit.register(session.close)
+            cls._session = session
+        return cls._session
+
+    _INPUT_TYPES = TOPAZ_INPUT_TYPES
+
+    def _call(self, method, url, **kwargs):
+        breaker = self._breaker
+        probe = False
+        with self._breaker_lock:
+            if breaker["fails"] >= BREAKER_THRESHOLD:
+                remaining = breaker["opened_at"] + BREAKER_COOLDOWN - time.time()
+                if remaining > 0:
+                    raise CircuitOpenError(f"Topaz API unavailable; circuit open for another {remaining:.0f}s")
+                if breaker["probing"]:
+                    raise CircuitOpenError("Topaz API unavailable; waiting on a probe request")
+                # Cooldown over: half-open, let exactly this request probe the service
+                breaker["probing"] = probe = True
+
+        try:
+            resp = self._session.request(method, url, **kwargs)
+        except requests.RequestException:
+            self._record_call(failed=True, probe=probe)
+            raise
+        except BaseException:
+            if probe:
+                with self._breaker_lock:
+                    breaker["probing"] = False
+            raise
+        self._record_call(failed=resp.status_code >= 500 or resp.status_code == 408, probe=probe)
+        return resp
+
+    def _record_call(self, failed, probe=False):
+        breaker = self._breaker
+        with self._breaker_lock:
+            if probe:
+                breaker["probing"] = False
+            if not failed:
+                breaker["fails"] = 0
+                return
+            breaker["fails"] += 1
+            if breaker["fails"] >= BREAKER_THRESHOLD:
+                breaker["opened_at"] = time.time()
+                log.warning("[Topaz] %d consecutive API failures → failing fast for %.0fs",
+                            breaker["fails"], BREAKER_COOLDOWN)
+
+    @classmethod
+    def _get_executor(cls):
+        with cls._executor_lock:
+            if cls._executor is None:
+                cls._executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_JOBS, thread_name_prefix="topaz")
+            return cls._executor
+
     @classmethod
     def INPUT_TYPES(cls):
-        return {
-            "required": {
-                "image": ("IMAGE",),
-                "api_key": ("STRING", {
-                    "multiline": False,
-                    "default": "",
-                    "placeholder": "Enter your Topaz API key"
-                }),
-                "mode": (TOPAZ_MODES, {"default": "enhance"}),
-                "model": (TOPAZ_MODELS, {"default": "Standard V2"}),
-                "scale_multiplier": ("FLOAT", {
-                    "default": 1.0,
-                    "min": 1.0,
-                    "max": 4.0,
-                    "step": 0.1,
-                    "display": "slider",
-                    "tooltip": "Set >1.0 to auto-upscale. Set exactly 1.0 to use manual width/height."
-                }),
-            },
-            "optional": {
-                "output_width": ("INT", {
-                    "default": 0,
-                    "min": 0,
-                    "max": 32000,
-                    "step": 64,
-                    "display": "number",
-                    "visible": {"condition": {"scale_multiplier": ["1.0"]}, "value": True},
-                    "tooltip": "Only used when scale_multiplier = 1.0"
-                }),
-                "output_height": ("INT", {
-                    "default": 0,
-                    "min": 0,
-                    "max": 32000,
-                    "step": 64,
-                    "display": "number",
-                    "visible": {"condition": {"scale_multiplier": ["1.0"]}, "value": True},
-                    "tooltip": "Only used when scale_multiplier = 1.0"
-                }),
-                "crop_to_fill": ("BOOLEAN", {"default": False}),
-                "output_format": (["jpeg", "png", "tiff"], {"default": "jpeg"}),
-                "face_enhancement": ("BOOLEAN", {"default": True}),
-                "denoise_strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
-                "sharpen_strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
-                "strength": ("FLOAT", {"default": 0.5, "min": 0.0, "max": 1.0, "step": 0.05}),
-                "fix_compression": ("FLOAT", {"default": 0.0, "min": 0.0, "max": 1.0, "step": 0.05}),
-                "timeout_seconds": ("INT", {"default": 300, "min": 60, "max": 1800, "step": 30}),
-            }
-        }
+        return cls._INPUT_TYPES
 
     RETURN_TYPES = ("IMAGE",)
     RETURN_NAMES = ("processed_image",)
@@ -92,73 +400,110 @@ class TopazUpscaler:
     CATEGORY = "image/topaz"
 
     def _get_submit_path(self, mode, model):
-        if mode == "enhance":
-            if model in ENHANCE_GEN_MODELS: return "/enhance-gen/async"
-            if model in ENHANCE_GAN_MODELS: return "/enhance/async"
-        elif mode == "sharpen":
-            if model in SHARPEN_GEN_MODELS: return "/sharpen-gen/async"
-            if model in SHARPEN_GAN_MODELS: return "/sharpen/async"
-        elif mode == "denoise":
-            if model in DENOISE_GAN_MODELS: return "/denoise/async"
-        elif mode == "restore":
-            if model in RESTORE_GEN_MODELS: return "/restore-gen/async"
-        elif mode == "lighting":
-            if model in LIGHTING_GAN_MODELS: return "/lighting/async"
-        raise ValueError(f"Invalid combination: mode='{mode}', model='{model}'")
-
-    def _submit_job(self, image_path, api_key, mode, model, params):
+        path = _SUBMIT_PATHS.get((mode, model))
+        if path is None:
+            raise ValueError(f"Invalid combination: mode='{mode}', model='{model}'")
+        return path
+
+    def _submit_job(self, image_bytes, image_format, mode, model, params):
         path = self._get_submit_path(mode, model)
-        headers = {"X-API-Key": api_key, "Accept": "application/json"}
-        with open(image_path, 'rb') as f:
-            files = {'image': (os.path.basename(image_path), f)}
-            data = {k: str(v) for k, v in params.items()}
-            response = requests.post(f"{BASE_URL}{path}", headers=headers, files=files, data=data, timeout=60)
+        suffix = "jpg" if image_format == "jpeg" else image_format
+        # Known-length bytes: a single Content-Length body, no chunked framing
+        files = {'image': (f"input.{suffix}", image_bytes, FORMAT_ACCEPT[image_format])}
+        for attempt in range(SUBMIT_RETRIES + 1):
+            response = self._call("POST", f"{BASE_URL}{path}", files=files, data=params,
+                                  timeout=(CONNECT_TIMEOUT, 60.0))
+            # 429/503 mean the job was refused before it started, so resubmitting can't duplicate it
+            if response.status_code not in (429, 503) or attempt == SUBMIT_RETRIES:
+                break
+            wait = _retry_after(response, RETRY_BACKOFF * 2 ** attempt) + random.uniform(0, RETRY_JITTER)
+            log.warning("[Topaz] Submit refused (%s) → retrying in %.1fs", response.status_code, wait)
+            time.sleep(wait)
         response.raise_for_status()
         resp_json = response.json()
-        print(f"[Topaz] Submit: {resp_json}")
+        log.debug("[Topaz] Submit: %s", resp_json)
 
         process_id = resp_json.get("process_id") or response.headers.get("X-Process-ID")
         if not process_id:
             raise ValueError("No process_id returned")
-        return process_id, 0
 
-    def _wait_for_completion(self, process_id, api_key, timeout):
-        headers = {"X-API-Key": api_key}
+        # "eta" is a Unix timestamp of the expected completion time
+        eta = resp_json.get("eta") or response.headers.get("X-ETA")
+        try:
+            eta_remaining = max(0.0, float(eta) - time.time()) if eta else 0.0
+        except (TypeError, ValueError):
+            eta_remaining = 0.0
+
+        # Only pay for localtime/strftime when the line will actually be emitted
+        if log.isEnabledFor(logging.INFO):
+            eta_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(time.time() + eta_remaining))
+            log.info("[Topaz] Process ID: %s | ETA: %s", process_id, eta_time if eta_remaining else "Unknown")
+        return process_id, eta_remaining
+
+    def _wait_for_completion(self, process_id, timeout, eta_remaining=0.0):
         start = time.time()
         url = f"{BASE_URL}/status/{process_id}"
-        print(f"[Topaz] Status URL: {url}")
-
-        while time.time() - start < timeout:
-            try:
-                resp = requests.get(url, headers=headers, timeout=30)
-                if resp.status_code == 404:
-                    time.sleep(5); continue
+        log.debug("[Topaz] Status URL: %s", url)
+
+        # Don't poll before the job can plausibly be done, then back off exponentially.
+        # Cap the wait inside the budget: an ETA past the timeout must still get polled
+        first_poll = min(eta_remaining * POLL_ETA_FRACTION, eta_remaining - POLL_ETA_MARGIN)
+        if first_poll > 0:
+            time.sleep(min(first_poll, timeout * POLL_ETA_FRACTION))
+        delay = max(POLL_INITIAL_DELAY, min(eta_remaining, POLL_INITIAL_MAX))
+        last_prog = last_prog_time = None
+        logged_state = logged_prog = None
+
+        while True:
+            resp = self._call("GET", url, timeout=(CONNECT_TIMEOUT, 30.0))
+            wait = delay
+            # 404: job not visible yet, keep polling; anything else non-2xx is fatal
+            if resp.status_code != 404:
                 resp.raise_for_status()
                 status = resp.json()
                 st = status.get("status", "").strip().lower()
                 prog = status.get("progress", "N/A")
-                print(f"[Topaz] Status: {st.capitalize()} | Progress: {prog}%")
+                # Log state changes and every 10% of progress, not every poll
+                if st != logged_state or _progress_step(prog, logged_prog) >= 10:
+                    log.info("[Topaz] Status: %s | Progress: %s%%", st, prog)
+                    logged_state, logged_prog = st, prog
 
                 if st == "completed":
-                    print("[Topaz] Job completed!")
+                    log.info("[Topaz] Job completed!")
                     return True
                 if st == "failed":
-                    raise Exception(f"Job failed: {status.get('error', 'Unknown error')}")
-            except Exception as e:
-                print(f"[Topaz] Status check error: {e}")
-            time.sleep(8)
-        raise TimeoutError(f"Timed out after {timeout}s")
-
-    def _download_result(self, process_id, api_key, output_format):
-        headers = {"X-API-Key": api_key, "Accept": "application/json"}
+                    raise RuntimeError(f"Job failed: {status.get('error', 'Unknown error')}")
+
+                # Extrapolate the finish from the progress rate and check back halfway there
+                try:
+                    prog = float(prog)
+                except (TypeError, ValueError):
+                    prog = None
+                now = time.time()
+                if prog is not None and (last_prog is None or prog > last_prog):
+                    if last_prog is not None:
+                        rate = (prog - last_prog) / (now - last_prog_time)
+                        wait = max(POLL_MIN_DELAY, min(wait, (100.0 - prog) / rate / 2))
+                    last_prog, last_prog_time = prog, now
+
+            remaining = timeout - (time.time() - start)
+            if remaining <= 0:
+                raise TimeoutError(f"Timed out after {timeout}s")
+            # Honour the server's pacing hint whenever it gives one; the sleep is clamped
+            # to the deadline and always followed by one last poll
+            wait = _retry_after(resp, wait)
+            time.sleep(min(wait, remaining))
+            delay = min(POLL_MAX_DELAY, delay * POLL_BACKOFF)
+
+    def _download_result(self, process_id, output_format, timeout_seconds=300):
         url = f"{BASE_URL}/download/{process_id}"
-        print(f"[Topaz] Download URL: {url}")
+        log.debug("[Topaz] Download URL: %s", url)
 
+        ranged = True
         for attempt in range(8):
-            resp = requests.get(url, headers=headers, timeout=30)
-            print(f"[Topaz] Download attempt {attempt+1} → {resp.status_code}")
-
+            resp = self._call("GET", url, timeout=(CONNECT_TIMEOUT, 30.0))
             if resp.status_code == 409:
+                log.debug("[Topaz] Download attempt %d → 409, result not ready", attempt + 1)
                 time.sleep(3); continue
 
             resp.raise_for_status()
@@ -167,104 +512,321 @@ class TopazUpscaler:
             if not dl_url:
                 raise ValueError("No download_url received")
 
-            img_resp = requests.get(dl_url, timeout=60)
-            img_resp.raise_for_status()
-            content = img_resp.content
-
-            # Validate format
-            if output_format == "jpeg" and content.startswith(FORMAT_MAGIC["jpeg"]):
-                pass
-            elif output_format == "png" and content.startswith(FORMAT_MAGIC["png"]):
-                pass
-            elif output_format == "tiff" and content[:4] in FORMAT_MAGIC["tiff"]:
-                pass
-            else:
-                print(f"[Topaz] Invalid image content → retrying...")
+            # Pre-signed URL on a third-party host: don't send it our API headers
+            read_timeout = min(timeout_seconds, 300)
+            with self._call("GET", dl_url, headers=NO_API_HEADERS, stream=True,
+                            timeout=(CONNECT_TIMEOUT, read_timeout)) as img_resp:
+                # Nothing but headers has been read yet: errors cost no body transfer
+                img_resp.raise_for_status()
+                if ranged and self._can_split(img_resp):
+                    try:
+                        buf = self._read_ranges(img_resp, dl_url, output_format, read_timeout)
+                    except (IOError, requests.RequestException, CircuitOpenError) as e:
+                        # The job is done and paid for: fall back to one stream rather than fail it
+                        log.warning("[Topaz] Ranged download failed (%s) → retrying as a single stream", e)
+                        ranged = False
+                        time.sleep(3)
+                        continue
+                else:
+                    buf = self._read_body(img_resp, output_format)
+
+            if buf is None:
+                log.warning("[Topaz] Invalid image content → retrying...")
                 time.sleep(3)
                 continue
 
-            print(f"[Topaz] Valid image received ({len(content)/1024:.1f} KB)")
-            return content
+            log.info("[Topaz] Valid image received (%.1f KB)", buf.getbuffer().nbytes / 1024)
+            # Hand the download buffer on as-is: no bytes copy before decode/save
+            return buf
 
         raise Exception("Failed to download valid image after retries")
 
-    def process(self, image, api_key, mode, model,
-                scale_multiplier=1.0, output_width=0, output_height=0, crop_to_fill=False,
-                output_format="jpeg", face_enhancement=True,
-                denoise_strength=0.5, sharpen_strength=0.5, strength=0.5,
-                fix_compression=0.0, timeout_seconds=300):
+    def _can_split(self, img_resp):
+        headers = img_resp.headers
+        return (int(headers.get("Content-Length") or 0) >= RANGE_MIN_BYTES
+                and headers.get("Accept-Ranges", "").lower() == "bytes"
+                and not headers.get("Content-Encoding"))
+
+    def _read_ranges(self, img_resp, dl_url, output_format, read_timeout):
+        # Stream the first slice from the open response while the others download
+        # on their own connections, all straight into one preallocated buffer
+        size = int(img_resp.headers["Content-Length"])
+        step = -(-size // RANGE_SLICES)
+        buf = io.BytesIO()
+        buf.seek(size - 1)
+        buf.write(b"\0")
+        with buf.getbuffer() as view:
+            _read_into(img_resp.raw, view, 0, 8)
+            if not _valid_magic(view[:8].tobytes(), output_format):
+                return None
+            with ThreadPoolExecutor(max_workers=RANGE_SLICES - 1) as pool:
+                futures = [pool.submit(self._fetch_range, dl_url, view, start, min(size, start + step), read_timeout)
+                           for start in range(step, size, step)]
+                _read_into(img_resp.raw, view, 8, step)
+                for f in futures:
+                    f.result()
+        log.debug("[Topaz] Downloaded %d bytes in %d ranges", size, len(futures) + 1)
+        buf.seek(0)
+        return buf
+
+    def _fetch_range(self, dl_url, view, start, end, read_timeout):
+        headers = dict(NO_API_HEADERS, Range=f"bytes={start}-{end - 1}")
+        with self._call("GET", dl_url, headers=headers, stream=True,
+                        timeout=(CONNECT_TIMEOUT, read_timeout)) as resp:
+            resp.raise_for_status()
+            if resp.status_code != 206:
+                raise IOError(f"Range request for bytes {start}-{end - 1} returned {resp.status_code}")
+            _read_into(resp.raw, view, start, end)
+
+    def _read_body(self, img_resp, output_format):
+        # Returns the body rewound in a BytesIO, or None if its magic bytes don't match
+        size = int(img_resp.headers.get("Content-Length") or 0)
+        if size >= 8 and not img_resp.headers.get("Content-Encoding"):
+            # Known size: allocate the final buffer once and read straight into it
+            buf = io.BytesIO()
+            buf.seek(size - 1)
+            buf.write(b"\0")
+            with buf.getbuffer() as view:
+                _read_into(img_resp.raw, view, 0, 8)
+                if not _valid_magic(view[:8].tobytes(), output_format):
+                    return None
+                _read_into(img_resp.raw, view, 8, size)
+            buf.seek(0)
+            return buf
+
+        # Unknown size (or encoded transfer): grow a BytesIO chunk by chunk
+        chunks = img_resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+        buf = io.BytesIO()
+        for chunk in chunks:
+            buf.write(chunk)
+            if buf.tell() >= 8:
+                break
+        # Validate format before pulling the rest of the body
+        if not _valid_magic(buf.getvalue()[:8], output_format):
+            return None
+        for chunk in chunks:
+            buf.write(chunk)
+        buf.seek(0)
+        return buf
+
+    def _to_uint8(self, frame):
+        return _quantize_u8(frame).cpu().numpy()
+
+    def _encode_input(self, frame, output_format, upload_quality=UPLOAD_JPEG_QUALITY):
+        # nvJPEG: encode on the GPU so only the compressed bytes cross to the host
+        if output_format == "jpeg" and frame.is_cuda and TopazUpscaler._gpu_jpeg:
+            try:
+                chw = _quantize_u8(frame).permute(2, 0, 1).contiguous()
+                return _encode_jpeg(chw, quality=upload_quality).cpu().numpy().tobytes()
+            except RuntimeError as e:  # torchvision built without nvJPEG support
+                TopazUpscaler._gpu_jpeg = False
+                log.warning("[Topaz] GPU JPEG encode unavailable (%s) → encoding on CPU", e)
+
+        img_np = self._to_uint8(frame)
+        # Encode in memory and upload straight from the buffer
+        if output_format == "jpeg" and _turbojpeg is not None:
+            return _turbojpeg.encode(img_np, quality=upload_quality, pixel_format=TJPF_RGB,
+                                     jpeg_subsample=TJSAMP_420)
 
-        if not api_key.strip():
-            raise ValueError("Topaz API key required")
+        pil_img = Image.fromarray(img_np)
+        save_args = {}
+        if output_format == "jpeg":
+            # Single Huffman pass: no optimize/progressive
+            save_args = {"quality": upload_quality, "optimize": False, "progressive": False, "subsampling": 2}
+        elif output_format == "png":
+            # zlib effort dominates PNG encode time for little size gain
+            save_args["compress_level"] = 1
+        elif output_format == "tiff":
+            save_args["compression"] = "tiff_deflate"
 
+        input_buf = io.BytesIO()
+        pil_img.save(input_buf, format=output_format.upper(), **save_args)
+        return input_buf.getvalue()
+
+    def _decode_result(self, result_buf):
+        # JPEG (the default output) decodes straight to an RGB array via libjpeg-turbo, skipping PIL
+        if _turbojpeg is not None:
+            # Decode from the download buffer in place: no bytes copy of the body
+            with result_buf.getbuffer() as view:
+                if view[:8].tobytes().startswith(FORMAT_MAGIC["jpeg"]):
+                    try:
+                        arr = _turbojpeg.decode(view, pixel_format=TJPF_RGB)
+                        result = torch.from_numpy(arr).div(255.0)
+                        log.debug("[Topaz] Decoded JPEG %s (turbojpeg)", tuple(result.shape))
+                        return result
+                    except (OSError, RuntimeError) as e:  # e.g. CMYK JPEGs
+                        log.debug("[Topaz] turbojpeg decode failed (%s) → falling back to PIL", e)
+            result_buf.seek(0)
+        result_pil = Image.open(result_buf)
+        result_pil.load()
+        result_format = result_pil.format
+        # Normalise to 8-bit RGB inside PIL (drops alpha, expands L/P/CMYK) so the array below is contiguous HxWx3
+        if result_pil.mode != "RGB":
+            result_pil = result_pil.convert("RGB")
+        arr = np.asarray(result_pil)
+        with warnings.catch_warnings():
+            # PIL's export is read-only; it is only read below, never written
+            warnings.simplefilter("ignore", UserWarning)
+            # Share the uint8 buffer, then normalise in one vectorised uint8 → float32 pass
+            result = torch.from_numpy(arr).div(255.0)
+        log.debug("[Topaz] Decoded %s %s", result_format, tuple(result.shape))
+        return result
+
+    def _run_job(self, frame, mode, model, params, output_format, timeout_seconds, use_cache, upload_quality):
+        input_bytes = self._encode_input(frame, output_format, upload_quality)
+        if use_cache:
+            key = _cache_key(input_bytes, mode, params)
+            cached = _cache_load(key, output_format)
+            if cached is not None:
+                log.info("[Topaz] Cache hit %s → skipping API call", key)
+                return cached
+
+        process_id, eta_remaining = self._submit_job(input_bytes, output_format, mode, model, params)
+
+        log.info("[Topaz] Waiting for completion (ETA %.0fs)...", eta_remaining)
+        self._wait_for_completion(process_id, timeout_seconds, eta_remaining)
+
+        log.info("[Topaz] Downloading result...")
+        result_buf = self._download_result(process_id, output_format, timeout_seconds)
+        if use_cache:
+            _cache_store(key, output_format, result_buf)
+        return result_buf
+
+    def _run_batch(self, image, api_key, mode, model, params, output_format, timeout_seconds,
+                   use_cache=True, upload_quality=UPLOAD_JPEG_QUALITY):
+        session = self._get_session()
+        session.headers["X-API-Key"] = api_key
+
+        frames = [image[i] for i in range(image.shape[0])]
+        log.info("[Topaz] Submitting %s | %s | %d frame(s)", mode, model, len(frames))
+        job = lambda frame: self._run_job(frame, mode, model, params, output_format, timeout_seconds,
+                                          use_cache, upload_quality)
+        if len(frames) == 1:
+            return [job(frames[0])]
+        # Jobs are network-bound: overlap them on the pooled session
+        return list(self._get_executor().map(job, frames))
+
+    def _build_params(self, image, mode, model,
+                      scale_multiplier=1.0, output_width=0, output_height=0, crop_to_fill=False,
+                      output_format="jpeg", face_enhancement=True,
+                      denoise_strength=0.5, sharpen_strength=0.5, strength=0.5,
+                      fix_compression=0.0):
+        # Fail fast on bad config or input instead of after encoding, upload and server-side rejection
+        self._get_submit_path(mode, model)
         h, w = image.shape[1], image.shape[2]
 
+        if image.shape[0] == 0 or h == 0 or w == 0:
+            raise ValueError(f"Empty input image: shape {tuple(image.shape)}")
+        if DEBUG_CHECKS:
+            if image.dtype not in (torch.float32, torch.float16):
+                raise ValueError(f"Expected float32/float16 image, got {image.dtype}")
+            if image.min() < 0.0 or image.max() > 1.0:
+                raise ValueError("Image values outside [0, 1]")
+
         # Auto-scale logic
         if scale_multiplier > 1.0:
             if output_width > 0 or output_height > 0:
-                print(f"[Topaz] Ignoring manual width/height → using scale_multiplier ×{scale_multiplier}")
-            new_w = max(64, min(32000, int(w * scale_multiplier)))
-            new_h = max(64, min(32000, int(h * scale_multiplier)))
+                log.info("[Topaz] Ignoring manual width/height → using scale_multiplier ×%s", scale_multiplier)
+            new_w = _clamp_dim(w * scale_multiplier)
+            new_h = _clamp_dim(h * scale_multiplier)
             output_width, output_height = new_w, new_h
-            print(f"[Topaz] Auto-scale ×{scale_multiplier}: {w}×{h} → {new_w}×{new_h}")
+            log.info("[Topaz] Auto-scale ×%s: %d×%d → %d×%d", scale_multiplier, w, h, new_w, new_h)
         else:
             if mode == "enhance" and output_width == 0 and output_height == 0:
-                print("[Topaz] No output size specified → using original dimensions")
+                log.info("[Topaz] No output size specified → using original dimensions")
+            elif mode == "enhance" and (0 < output_width < w or 0 < output_height < h):
+                log.warning("[Topaz] Output %d×%d is smaller than input %d×%d; enhance expects an upscale",
+                            output_width, output_height, w, h)
 
+        # Form-ready strings: the server expects lowercase booleans
         params = {
             "model": model,
             "output_format": output_format,
-            "face_enhancement": str(face_enhancement).lower(),
-            "denoise_strength": denoise_strength,
-            "sharpen_strength": sharpen_strength,
-            "strength": strength,
-            "fix_compression": fix_compression,
+            "face_enhancement": "true" if face_enhancement else "false",
+            "denoise_strength": _form_float(denoise_strength),
+            "sharpen_strength": _form_float(sharpen_strength),
+            "strength": _form_float(strength),
+            "fix_compression": _form_float(fix_compression),
         }
         if mode == "enhance":
-            if output_width: params["output_width"] = output_width
-            if output_height: params["output_height"] = output_height
-            params["crop_to_fill"] = str(crop_to_fill).lower()
+            if output_width: params["output_width"] = str(int(output_width))
+            if output_height: params["output_height"] = str(int(output_height))
+            params["crop_to_fill"] = "true" if crop_to_fill else "false"
+        return params
 
-        # Save input image
-        img_np = (image[0].cpu().numpy() * 255).astype(np.uint8)
-        pil_img = Image.fromarray(img_np)
-        suffix = ".jpg" if output_format == "jpeg" else f".{output_format}"
-        save_args = {"quality": 95} if output_format == "jpeg" else {}
-        if output_format == "png":
-            save_args["compress_level"] = 4
-        elif output_format == "tiff":
-            save_args["compression"] = "tiff_deflate"
+    def process(self, image, api_key, mode, model,
+                scale_multiplier=1.0, output_width=0, output_height=0, crop_to_fill=False,
+                output_format="jpeg", face_enhancement=True,
+                denoise_strength=0.5, sharpen_strength=0.5, strength=0.5,
+                fix_compression=0.0, timeout_seconds=300, upload_quality=UPLOAD_JPEG_QUALITY, use_cache=True):
 
-        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
-            pil_img.save(tmp.name, format=output_format.upper(), **save_args)
-            input_path = tmp.name
+        if not api_key.strip():
+            raise ValueError("Topaz API key required")
 
-        try:
-            print(f"[Topaz] Submitting {mode} | {model}")
-            process_id, _ = self._submit_job(input_path, api_key, mode, model, params)
+        params = self._build_params(image, mode, model, scale_multiplier, output_width, output_height,
+                                    crop_to_fill, output_format, face_enhancement,
+                                    denoise_strength, sharpen_strength, strength, fix_compression)
+        results = [self._decode_result(buf) for buf in
+                   self._run_batch(image, api_key, mode, model, params, output_format, timeout_seconds,
+                                   use_cache, upload_quality)]
 
-            print(f"[Topaz] Waiting for completion...")
-            self._wait_for_completion(process_id, api_key, timeout_seconds)
+        # Critical: return PyTorch tensor, not numpy
+        if len(results) == 1:
+            result_tensor = results[0].unsqueeze(0)
+        else:
+            result_tensor = torch.stack(results)
 
-            print(f"[Topaz] Downloading result...")
-            result_bytes = self._download_result(process_id, api_key, output_format)
+        log.info("[Topaz] Success! Output: %s", tuple(result_tensor.shape))
+        return (result_tensor,)
 
-            result_pil = Image.open(io.BytesIO(result_bytes))
-            result_np = np.array(result_pil).astype(np.float32) / 255.0
-            if result_np.ndim == 3 and result_np.shape[2] == 4:
-                result_np = result_np[:, :, :3]
 
-            # Critical: return PyTorch tensor, not numpy
-            result_tensor = torch.from_numpy(result_np).unsqueeze(0)
+# Writes the file returned by Topaz straight to the output folder, skipping the decode to a tensor
+class TopazUpscalerSave(TopazUpscaler):
+    _INPUT_TYPES = {
+        "required": {**TOPAZ_INPUT_TYPES["required"], "filename_prefix": ("STRING", {"default": "Topaz"})},
+        "optional": TOPAZ_INPUT_TYPES["optional"],
+    }
 
-            print(f"[Topaz] Success! Output: {result_tensor.shape} | {result_pil.format}")
-            return (result_tensor,)
+    RETURN_TYPES = ()
+    RETURN_NAMES = ()
+    FUNCTION = "save"
+    OUTPUT_NODE = True
 
-        finally:
-            if os.path.exists(input_path):
-                os.unlink(input_path)
+    def save(self, image, api_key, mode, model, filename_prefix="Topaz",
+             output_format="jpeg", timeout_seconds=300, upload_quality=UPLOAD_JPEG_QUALITY, use_cache=True,
+             **kwargs):
 
+        if not api_key.strip():
+            raise ValueError("Topaz API key required")
 
-NODE_CLASS_MAPPINGS = {"TopazUpscaler": TopazUpscaler}
-NODE_DISPLAY_NAME_MAPPINGS = {"TopazUpscaler": "Topaz Upscaler (API)"}
+        params = self._build_params(image, mode, model, output_format=output_format, **kwargs)
+        results = self._run_batch(image, api_key, mode, model, params, output_format, timeout_seconds,
+                                  use_cache, upload_quality)
+
+        # %width%/%height% describe the files written: read the upscaled size from the result header
+        with Image.open(results[0]) as result_pil:
+            out_w, out_h = result_pil.size
+        full_output_folder, filename, counter, subfolder, _ = folder_paths.get_save_image_path(
+            filename_prefix, folder_paths.get_output_directory(), out_w, out_h)
+        ext = "jpg" if output_format == "jpeg" else output_format
+        saved = []
+        for batch_number, result_buf in enumerate(results):
+            file = f"{filename.replace('%batch_num%', str(batch_number))}_{counter:05}_.{ext}"
+            with open(os.path.join(full_output_folder, file), "wb") as f:
+                f.write(result_buf.getbuffer())
+            saved.append({"filename": file, "subfolder": subfolder, "type": "output"})
+            counter += 1
+
+        log.info("[Topaz] Saved %d file(s) to %s", len(saved), full_output_folder)
+        return {"ui": {"images": saved}}
+
+
+NODE_CLASS_MAPPINGS = {
+    "TopazUpscaler": TopazUpscaler,
+    "TopazUpscalerSave": TopazUpscalerSave,
+}
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "TopazUpscaler": "Topaz Upscaler (API)",
+    "TopazUpscalerSave": "Topaz Upscaler → Save (API)",
+}
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS']